@@ -0,0 +1,81 @@
+"""Бенчмарк генерации сертификатов: сертификатов в секунду до и после шаблонов
+
+Запуск из корня репозитория:
+    python benchmarks/bench_certificates.py [--count 200]
+
+"до"    - как раньше: каждый сертификат заново загружает logo.png и рисует весь макет
+"после" - render_certificate_pdf: готовый шаблон языка + только персональные поля
+"после, без кэша глифов" - то же, но подмножества TTF-шрифтов собираются заново
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+import flashcards  # noqa: E402
+from reportlab.pdfbase import pdfmetrics  # noqa: E402
+from reportlab.pdfgen import canvas  # noqa: E402
+
+STUDENT = "Иванова Анна Сергеевна"
+COURSE = "Основы программирования на Python"
+DATE = "19.10.2026"
+NUMBER = "№ 20261019-0042"
+
+
+def render_uncached(language):
+    """Старый путь: логотип и статический макет на каждый запрос"""
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=flashcards.CERTIFICATE_PAGE_SIZE)
+    logo = flashcards.get_certificate_logo()
+    flashcards.draw_certificate_static(c, language, logo)
+    flashcards.draw_certificate_fields(c, language, STUDENT, COURSE, DATE, NUMBER)
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def render_templated(language):
+    return flashcards.render_certificate_pdf(STUDENT, COURSE, DATE, language, NUMBER)
+
+
+def render_templated_no_subset_cache(language):
+    for font_name in set(flashcards.get_certificate_fonts().values()):
+        make_subset = pdfmetrics.getFont(font_name).face.makeSubset
+        if hasattr(make_subset, 'cache_clear'):
+            make_subset.cache_clear()
+    return render_templated(language)
+
+
+def measure(render, language, count):
+    render(language)  # прогрев
+    start = time.perf_counter()
+    for _ in range(count):
+        size = len(render(language))
+    elapsed = time.perf_counter() - start
+    return count / elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=200)
+    args = parser.parse_args()
+
+    modes = (
+        ('до', render_uncached),
+        ('после, без кэша глифов', render_templated_no_subset_cache),
+        ('после', render_templated),
+    )
+    print(f"Шрифты: {flashcards.get_certificate_fonts()}")
+    print(f"{'режим':<24} {'язык':<5} {'серт/с':>10} {'размер PDF':>12}")
+    for language in ('ru', 'kz'):
+        for label, render in modes:
+            rate, size = measure(render, language, args.count)
+            print(f"{label:<24} {language:<5} {rate:>10.1f} {size:>10} B")
+
+
+if __name__ == '__main__':
+    main()
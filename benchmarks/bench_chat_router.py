@@ -0,0 +1,115 @@
+"""Микробенчмарк быстрых ответов чата: цепочка any(...) против IntentRouter
+
+Запуск из корня репозитория:
+    python benchmarks/bench_chat_router.py [--count 20000]
+
+"до"    - прежняя цепочка проверок `any(word in lowerMessage for word in [...])`
+"до, вся таблица" - та же цепочка, но по всем фразам CHAT_INTENTS (ru + kk)
+"после" - chat_intent_router.answer: скомпилированные регулярки на все фразы
+
+Кроме времени на сообщение печатается, сколько сообщений из набора обработано
+локально (без вызова Gemini) и какие из них раньше получали не тот ответ.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+import flashcards  # noqa: E402
+
+MESSAGES = [
+    "Как создать курс из PDF?",
+    "Хочу сделать курс по биологии",
+    "Где флеш-карты?",
+    "Как сделать тестовые задания?",
+    "Нужны практические задания по Python",
+    "Составь план урока по истории",
+    "Привет!",
+    "Привет, расскажи про фотосинтез",
+    "Спасибо",
+    "Где скачать сертификат?",
+    "Как сделать презентацию?",
+    "Что есть в библиотеке?",
+    "Что такое фотосинтез?",
+    "Объясни закон Ома простыми словами",
+    "Сәлеметсіз бе!",
+    "Курс құру үшін не істеу керек?",
+    "Флеш-карталар қалай жасалады?",
+    "Тест тапсырмаларын жасау",
+    "Тапсырмалар жасау керек",
+    "Сабақ жоспарын құруға көмектес",
+    "Рахмет!",
+    "Фотосинтез дегеніміз не?",
+]
+
+
+def legacy_intent(message):
+    """Прежняя логика chat(): первая сработавшая проверка по порядку"""
+    lowerMessage = message.lower()
+    if any(word in lowerMessage for word in ['создать курс', 'создай курс', 'новый курс', 'сделать курс']):
+        return 'create_course'
+    if any(word in lowerMessage for word in ['флеш-карт', 'флешкарт', 'карточки']):
+        return 'flashcards'
+    if any(word in lowerMessage for word in ['тест', 'задани']):
+        return 'tests'
+    if any(word in lowerMessage for word in ['генератор', 'генерация', 'практическ']):
+        return 'assignment_generator'
+    if any(word in lowerMessage for word in ['план урока', 'учебный план']):
+        return 'lesson_plan'
+    return None
+
+
+# Цепочка any() по всей таблице интентов в порядке приоритета
+LEGACY_TABLE = [
+    (intent["name"], [phrase for phrases in intent["phrases"].values() for phrase in phrases])
+    for intent in sorted(flashcards.CHAT_INTENTS, key=lambda intent: -intent["priority"])
+]
+
+
+def legacy_table_intent(message):
+    lowerMessage = message.lower()
+    for name, phrases in LEGACY_TABLE:
+        if any(word in lowerMessage for word in phrases):
+            return name
+    return None
+
+
+def router_intent(message):
+    return flashcards.chat_intent_router.answer(message)[0]
+
+
+def measure(route, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        for message in MESSAGES:
+            route(message)
+    return (time.perf_counter() - start) / (count * len(MESSAGES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    modes = (
+        ('до', legacy_intent),
+        ('до, вся таблица', legacy_table_intent),
+        ('после', router_intent),
+    )
+    print(f"{'режим':<16} {'мкс/сообщ.':>11} {'без AI':>8}")
+    for label, route in modes:
+        local = sum(1 for message in MESSAGES if route(message))
+        print(f"{label:<16} {measure(route, args.count):>11.2f} {local:>5}/{len(MESSAGES)}")
+
+    print("\nОтличия:")
+    for message in MESSAGES:
+        before, after = legacy_intent(message), router_intent(message)
+        if before != after:
+            print(f"  {message!r}: {before} -> {after}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Бенчмарк токенов чата на локальной заглушке Gemini: без сессий и с ними
+
+Запуск из корня репозитория (ключ и сеть не нужны):
+    python benchmarks/bench_chat_sessions.py [--turns 12]
+
+"до"              - как раньше: каждый вопрос отдельным промптом с полным
+                    описанием платформы, без памяти разговора
+"сессия"          - /api/chat с session_id, описание платформы в systemInstruction
+
+История ограничена CHAT_HISTORY_TOKEN_BUDGET, поэтому стоимость хода
+перестаёт расти. Описание платформы (~400 токенов) меньше минимального
+размера кэша Gemini (1024 токена) и оплачивается в каждом ходе.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_gemini  # noqa: E402
+
+QUESTIONS = [
+    "Что такое фотосинтез?",
+    "А где именно он происходит в клетке?",
+    "Какие вещества для него нужны?",
+    "Как объяснить это шестиклассникам?",
+    "Придумай простой опыт для урока",
+    "Сколько времени займёт этот опыт?",
+    "Какие меры безопасности нужны?",
+    "Как оценить, что ученики поняли тему?",
+    "Чем хемосинтез отличается от него?",
+    "Какие бактерии способны к хемосинтезу?",
+    "Как связать это с экологией?",
+    "Подведи итог нашего разговора в двух предложениях",
+]
+
+
+def start_fake_gemini():
+    app = fake_gemini.create_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return app, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--turns', type=int, default=len(QUESTIONS))
+    args = parser.parse_args()
+
+    fake, base_url = start_fake_gemini()
+    os.environ['GEMINI_API_BASE'] = base_url
+    os.environ['GEMINI_API_KEY'] = 'fake-key'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')  # без строк лога на каждый вызов API
+    os.environ.setdefault('CHAT_SESSION_DB_PATH', os.path.join(tempfile.mkdtemp(), 'chat_sessions.db'))
+    import flashcards
+
+    questions = [QUESTIONS[i % len(QUESTIONS)] + (f" ({i})" if i >= len(QUESTIONS) else "")
+                 for i in range(args.turns)]
+
+    def run_legacy():
+        for question in questions:
+            flashcards.call_gemini_api(f"{flashcards.CHAT_SYSTEM_PREAMBLE}\n\nВопрос пользователя: {question}",
+                                       max_tokens=500)
+
+    def run_session():
+        flashcards.chat_answer_cache = flashcards.ChatAnswerCache(100, 3600, 0.85)
+        client = flashcards.app.test_client()
+        session_id = None
+        for question in questions:
+            reply = client.post('/api/chat', json={'message': question, 'session_id': session_id}).get_json()
+            session_id = reply['session_id']
+        return flashcards.chat_sessions.get(session_id)
+
+    print(f"Описание платформы: ~{flashcards.estimate_tokens(flashcards.CHAT_SYSTEM_PREAMBLE)} токенов, "
+          f"ходов: {len(questions)}, бюджет истории: {flashcards.CHAT_HISTORY_TOKEN_BUDGET}")
+    print(f"{'режим':<14} {'токенов в запросах':>19} {'последний ход':>14}")
+    for label, run in (('до', run_legacy), ('сессия', run_session)):
+        fake.calls.clear()
+        session = run()
+        calls = list(fake.calls)
+        total = sum(call["promptTokenCount"] for call in calls)
+        print(f"{label:<14} {total:>19} {calls[-1]['promptTokenCount']:>14}")
+
+    print(f"\nистория: {len(session.turns)} ходов (~{session.tokens} токенов), "
+          f"в резюме: {len(session.summary)} ранних вопросов")
+
+
+if __name__ == '__main__':
+    main()
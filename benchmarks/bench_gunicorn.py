@@ -0,0 +1,156 @@
+"""Бенчмарк настроек gunicorn на ожидании Gemini (заглушка с задержкой)
+
+Запуск из корня репозитория (Linux, нужен gunicorn из requirements.txt):
+    python benchmarks/bench_gunicorn.py [--latency 1.0] [--clients 64] [--duration 8]
+
+Заглушка Gemini отвечает с задержкой --latency секунд; --clients клиентов
+в течение --duration секунд шлют /api/generate-theory (один вызов ИИ на
+запрос). Для каждой конфигурации gunicorn печатается пропускная способность,
+задержка p50/p95 (с очередью перед воркером), число неуспешных запросов и
+память всех процессов gunicorn.
+
+"без конфига"   - умолчания gunicorn: 1 синхронный воркер, timeout 30 с
+"sync x4"       - 4 синхронных воркера: 4 ожидания одновременно
+"gthread 2x8"   - 2 воркера по 8 потоков
+"gunicorn.conf" - gunicorn.conf.py из репозитория (1 x 64 потока, preload)
+
+Синхронный воркер держит процесс на всё ожидание ответа (у Gemini - до
+90 с), и с timeout 30 с по умолчанию мастер убивает его посреди ответа.
+"""
+import argparse
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_gemini  # noqa: E402
+
+CONFIGS = [
+    ("без конфига", None, []),
+    ("sync x4", None, ["--worker-class", "sync", "--workers", "4"]),
+    ("gthread 2x8", None, ["--worker-class", "gthread", "--workers", "2", "--threads", "8"]),
+    ("gunicorn.conf", os.path.join(ROOT, "gunicorn.conf.py"), []),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss_mb(pid):
+    """RSS мастера и всех его потомков (из /proc)"""
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, StopIteration):
+            continue
+    return total / 1024
+
+
+def start_gunicorn(config_path, extra_args, env, port):
+    empty_config = None
+    if config_path is None:
+        empty_config = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+        empty_config.close()
+        config_path = empty_config.name
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'flashcards:app', '-c', config_path,
+         '--bind', f'127.0.0.1:{port}', *extra_args],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/api/health/live', timeout=1).ok:
+                break
+        except requests.RequestException:
+            time.sleep(0.2)
+    else:
+        process.kill()
+        raise RuntimeError("gunicorn не запустился")
+    if empty_config:
+        os.unlink(empty_config.name)
+    return process
+
+
+def load(port, clients, duration, request_timeout):
+    url = f'http://127.0.0.1:{port}/api/generate-theory'
+    stop_at = time.monotonic() + duration
+    latencies, failures = [], []
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            try:
+                ok = session.post(url, json={'content': f'Тема {next(counter)}: фотосинтез'},
+                                  timeout=request_timeout).ok
+            except requests.RequestException:
+                ok = False
+            with lock:
+                (latencies if ok else failures).append(time.monotonic() - started)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(clients) as pool:
+        for _ in range(clients):
+            pool.submit(client)
+    elapsed = time.monotonic() - started
+    return len(latencies) / elapsed, sorted(latencies), len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=1.0)
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=8.0)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # без строки на каждый вызов заглушки
+    fake = fake_gemini.create_app(latency=args.latency)
+    server = make_server('127.0.0.1', 0, fake, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    db_dir = tempfile.mkdtemp()
+    env = dict(os.environ, GEMINI_API_BASE=f'http://127.0.0.1:{server.server_port}', GEMINI_API_KEY='fake-key',
+               LOG_LEVEL='WARNING', DATA_DIR=db_dir, CERTIFICATE_DB_PATH=os.path.join(db_dir, 'certificates.db'),
+               TOKEN_USAGE_DB_PATH=os.path.join(db_dir, 'token_usage.db'))
+
+    print(f"Задержка Gemini: {args.latency} с, клиентов: {args.clients}, {args.duration:.0f} с на конфигурацию")
+    print(f"{'конфигурация':<14} {'запросов/с':>11} {'p50, с':>7} {'p95, с':>7} {'ошибок':>7} {'RSS, МБ':>8}")
+    for label, config_path, extra_args in CONFIGS:
+        port = free_port()
+        process = start_gunicorn(config_path, extra_args, env, port)
+        try:
+            rps, latencies, failures = load(port, args.clients, args.duration, args.duration + 5)
+            rss = process_tree_rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait(timeout=120)
+        p50 = statistics.median(latencies) if latencies else float('nan')
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else float('nan')
+        print(f"{label:<14} {rps:>11.1f} {p50:>7.2f} {p95:>7.2f} {failures:>7} {rss:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
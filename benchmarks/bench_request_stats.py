@@ -0,0 +1,65 @@
+"""Бенчмарк накладных расходов гистограмм задержек (/api/stats) на запрос
+
+Запуск из корня репозитория:
+    python benchmarks/bench_request_stats.py [--count 20000]
+
+"запись"          - route_stats.record: корзины общего времени и четырёх фаз
+"хук"             - record_route_latency целиком (фазы из g, маршрут, запись)
+"запрос без хука" / "запрос с хуком" - GET /api/grading-cache/stats через
+                    test_client; разница - то, что хук добавляет к запросу
+Цель - меньше 50 мкс на запрос.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import flashcards  # noqa: E402
+from flask import g  # noqa: E402
+
+
+def per_call_us(func, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    app = flashcards.app
+    stats = flashcards.RouteLatencyStats()
+    phases = {'upstream': 812.0, 'parse': 1.4, 'render': 0.3, 'other': 5.2}
+    record_us = per_call_us(lambda: stats.record('POST /api/generate-quiz', 200, 819.0, phases), args.count)
+
+    with app.test_request_context('/api/generate-quiz', method='POST'):
+        g.request_started = time.perf_counter()
+        g.phases = {'upstream': 0.8, 'parse': 0.001}
+        response = app.response_class('{}')
+        hook_us = per_call_us(lambda: flashcards.record_route_latency(response), args.count)
+
+    client = app.test_client()
+    requests_count = max(1, args.count // 10)
+    hooks = app.after_request_funcs.setdefault(None, [])
+    hooks.remove(flashcards.record_route_latency)
+    without_us = per_call_us(lambda: client.get('/api/grading-cache/stats'), requests_count)
+    hooks.append(flashcards.record_route_latency)
+    with_us = per_call_us(lambda: client.get('/api/grading-cache/stats'), requests_count)
+
+    print(f"{'замер':<18} {'мкс на вызов':>13}")
+    print(f"{'запись':<18} {record_us:>13.2f}")
+    print(f"{'хук':<18} {hook_us:>13.2f}")
+    print(f"{'запрос без хука':<18} {without_us:>13.1f}")
+    print(f"{'запрос с хуком':<18} {with_us:>13.1f}")
+    print(f"\nкорзин в гистограмме: {len(flashcards.LATENCY_BOUNDS_MS)}, "
+          f"p95 в снимке: {stats.snapshot()['routes'][0]['p95']} мс (записанное значение 819)")
+
+
+if __name__ == '__main__':
+    main()
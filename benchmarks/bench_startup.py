@@ -0,0 +1,94 @@
+"""Бенчмарк холодного старта: время импорта и память воркера
+
+Запуск из корня репозитория (Linux - память читается из /proc):
+    python benchmarks/bench_startup.py [--workers 2] [--repeat 3]
+
+Каждый режим запускается в отдельном интерпретаторе:
+"лениво"  - import flashcards как сейчас: reportlab грузится при первом сертификате
+"preload" - PRELOAD_HEAVY_MODULES=1: всё загружено при импорте (мастер gunicorn)
+
+Печатается время импорта, RSS после импорта, время первого сертификата и
+частная память (Private_*, не общая с мастером) каждого воркера после fork
+и одного сертификата. С preload первый сертификат в воркере не платит за
+загрузку reportlab и шрифтов, а эти страницы остаются общими.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def memory_kb(field_names, path='/proc/self/smaps_rollup'):
+    """Сумма полей smaps_rollup в КБ (RSS, Private_Clean + Private_Dirty ...)"""
+    total = 0
+    with open(path) as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in field_names:
+                total += int(rest.split()[0])
+    return total
+
+
+def child(workers):
+    """Измерения внутри свежего интерпретатора; результат - JSON в stdout"""
+    started = time.perf_counter()
+    import flashcards
+    import_ms = (time.perf_counter() - started) * 1000
+    result = {"import_ms": import_ms, "rss_mb": memory_kb({'Rss'}) / 1024, "workers": []}
+
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            started = time.perf_counter()
+            flashcards.render_certificate_pdf("Иванова Анна", "Python", "19.10.2026", "ru", "№ 1")
+            first_ms = (time.perf_counter() - started) * 1000
+            private_mb = memory_kb({'Private_Clean', 'Private_Dirty'}) / 1024
+            os.write(write_fd, json.dumps({"first_ms": first_ms, "private_mb": private_mb}).encode())
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            result["workers"].append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+    print(json.dumps(result))
+
+
+def run_mode(preload, workers):
+    env = dict(os.environ, LOG_LEVEL='WARNING', PRELOAD_HEAVY_MODULES='1' if preload else '0')
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', '--workers', str(workers)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        child(args.workers)
+        return
+
+    print(f"{'режим':<9} {'импорт, мс':>11} {'RSS, МБ':>8} {'1-й серт., мс':>14} {'частная память воркера, МБ':>27}")
+    for label, preload in (('лениво', False), ('preload', True)):
+        runs = [run_mode(preload, args.workers) for _ in range(args.repeat)]
+        workers = [worker for run in runs for worker in run["workers"]]
+        print(f"{label:<9} {statistics.median(run['import_ms'] for run in runs):>11.0f} "
+              f"{statistics.median(run['rss_mb'] for run in runs):>8.1f} "
+              f"{statistics.median(worker['first_ms'] for worker in workers):>14.1f} "
+              f"{statistics.median(worker['private_mb'] for worker in workers):>27.1f}")
+
+
+if __name__ == '__main__':
+    main()
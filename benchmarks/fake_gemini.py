@@ -0,0 +1,130 @@
+"""Локальная заглушка Gemini API: проверка чата без ключа и сети
+
+Запуск:
+    python benchmarks/fake_gemini.py [--port 8765] [--min-cache-tokens 0] [--latency 0]
+    GEMINI_API_BASE=http://127.0.0.1:8765 GEMINI_API_KEY=test python flashcards.py
+
+Поддерживает generateContent, streamGenerateContent (?alt=sse, ответ по словам
+с паузой --stream-delay), GET метаданных модели и v1beta cachedContents. Токены
+считаются грубо (~3 символа на токен). В usageMetadata, как у настоящего API,
+возвращаются promptTokenCount и cachedContentTokenCount - по ним видно, сколько
+токенов ход стоил бы без кэша. --min-cache-tokens имитирует минимальный размер
+кэша модели (у gemini-2.5-flash - 1024 токена). --latency задерживает ответ
+generateContent, как ожидание генерации у настоящего API.
+"""
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+
+
+def estimate_tokens(text):
+    return len(text) // 3 + 1
+
+
+def count_tokens(*blocks):
+    """Токены в systemInstruction / contents (объекты с parts или их списки)"""
+    total = 0
+    for block in blocks:
+        for content in block if isinstance(block, list) else [block]:
+            for part in (content or {}).get("parts", []):
+                total += estimate_tokens(part.get("text", ""))
+    return total
+
+
+def error(status, message):
+    return jsonify({"error": {"code": status, "message": message}}), status
+
+
+def create_app(min_cache_tokens=0, stream_delay=0.05, latency=0.0):
+    """Приложение-заглушка; app.calls - usageMetadata всех вызовов generateContent"""
+    app = Flask(__name__)
+    app.calls = []
+    caches = {}
+    names = itertools.count(1)
+    lock = threading.Lock()
+
+    @app.route('/v1beta/cachedContents', methods=['POST'])
+    def create_cached_content():
+        body = request.get_json()
+        tokens = count_tokens(body.get("systemInstruction"), body.get("contents", []))
+        if tokens < min_cache_tokens:
+            return error(400, f"Cached content is too small. total_token_count={tokens}, "
+                              f"min_total_token_count={min_cache_tokens}")
+        with lock:
+            name = f"cachedContents/fake-{next(names)}"
+            caches[name] = tokens
+        return jsonify({"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+
+    @app.route('/<version>/models/<model>', methods=['GET'])
+    def get_model(version, model):
+        return jsonify({"name": f"models/{model}", "inputTokenLimit": 1048576})
+
+    @app.route('/<version>/models/<model_method>', methods=['POST'])
+    def generate_content(version, model_method):
+        if not model_method.endswith((':generateContent', ':streamGenerateContent')):
+            return error(404, f"Unknown method {model_method}")
+        body = request.get_json()
+
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            if body.get("systemInstruction"):
+                return error(400, "CachedContent can not be used with system_instruction")
+            with lock:
+                cached_tokens = caches.get(body["cachedContent"])
+            if cached_tokens is None:
+                return error(404, f"CachedContent not found: {body['cachedContent']}")
+
+        contents = body.get("contents", [])
+        question = contents[-1]["parts"][0]["text"] if contents else ""
+        # Длина как у настоящего ответа чата (2-4 предложения)
+        answer = (f"Ответ заглушки ({len(contents) // 2} предыдущих ходов) на: {question[:60]}. "
+                  + "Здесь модель дала бы короткое пояснение с примером для урока. " * 5).strip()
+
+        usage = {
+            "promptTokenCount": cached_tokens + count_tokens(body.get("systemInstruction"), contents),
+            "candidatesTokenCount": estimate_tokens(answer)
+        }
+        if cached_tokens:
+            usage["cachedContentTokenCount"] = cached_tokens
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+        with lock:
+            app.calls.append(usage)
+
+        if model_method.endswith(':streamGenerateContent'):
+            def generate():
+                words = re.findall(r'\S+\s*', answer)
+                for i, word in enumerate(words):
+                    chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": word}]}}]}
+                    if i == len(words) - 1:
+                        chunk["candidates"][0]["finishReason"] = "STOP"
+                        chunk["usageMetadata"] = usage
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+                    time.sleep(stream_delay)
+            return Response(generate(), mimetype='text/event-stream')
+
+        time.sleep(latency)
+        return jsonify({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}, "finishReason": "STOP"}],
+            "usageMetadata": usage
+        })
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--min-cache-tokens', type=int, default=0)
+    parser.add_argument('--stream-delay', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    create_app(args.min_cache_tokens, args.stream_delay, args.latency).run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Настройки gunicorn для продакшена
+
+Запуск из корня репозитория (файл подхватывается автоматически):
+    gunicorn flashcards:app
+
+Запросы к ИИ почти всё время ждут Gemini (до 90 секунд, timeout=90 в
+post_gemini), процессор при этом свободен. Поэтому воркеры - потоковые
+(gthread): каждый поток держит одно ожидание, а синхронный воркер на время
+ответа Gemini был бы занят целиком. Числа обоснованы в
+benchmarks/bench_gunicorn.py; любое значение можно переопределить переменной
+окружения или ключом командной строки gunicorn.
+
+По умолчанию воркер один, а параллельность набирается потоками. Сессии
+чата, сертификаты и учёт токенов уже в SQLite (DATA_DIR), но кэши ответов и
+проверок, кэш преамбулы Gemini, бандлы страниц, пул песочницы и снимок
+диагностики - в памяти процесса: каждый воркер держал бы свою копию, с
+промахами кэша и повторными вызовами Gemini. GUNICORN_WORKERS больше 1 -
+только после переноса этого состояния в общее хранилище.
+"""
+import os
+
+# Ответ Gemini ждём до 90 с; запас на промпт, разбор и рендер
+UPSTREAM_TIMEOUT = 90
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', 8000)}")
+
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 64))
+
+# Воркер, который не отвечает мастеру дольше timeout, перезапускается.
+# В gthread heartbeat шлёт главный поток, но при зависшем GIL (PDF, regex)
+# таймаут меньше ожидания Gemini убил бы и идущие запросы.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", UPSTREAM_TIMEOUT + 30))
+# SIGTERM: новые соединения не принимаются, идущие запросы дожидают ответ Gemini
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", UPSTREAM_TIMEOUT + 10))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Приложение (страницы, ассеты, reportlab, шаблоны сертификатов) загружается
+# один раз в мастере; воркеры делят эти страницы памяти через fork
+preload_app = True
+os.environ.setdefault("PRELOAD_HEAVY_MODULES", "1")
+
+# Перезапуск воркера после N запросов против медленного роста памяти;
+# jitter разносит перезапуски воркеров во времени
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+# Строку на каждый запрос пишет само приложение (JSON-лог с request_id)
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# Heartbeat-файлы воркеров - в памяти, а не на диске контейнера
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+
+def post_worker_init(worker):
+    """Фоновый поток записи логов - только в воркерах, которые обслуживают запросы"""
+    import flashcards
+    flashcards.start_log_listener()
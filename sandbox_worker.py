@@ -0,0 +1,208 @@
+"""Рабочий процесс песочницы для проверки Python-кода студентов
+
+Запускается пулом из flashcards.py (PythonSandboxPool) и живёт долго:
+читает задания построчно из stdin (JSON), на каждое делает fork и
+выполняет код в дочернем процессе, отвечает одной строкой JSON в stdout.
+
+Граница безопасности - изоляция ОС, которую задаёт пул: bubblewrap или
+unshare (своё сетевое пространство без интерфейсов, свои PID/IPC) и
+непривилегированный пользователь: запущенный под root рабочий процесс после
+загрузки модулей переходит на SANDBOX_UID. Audit hook ниже - только
+дополнительный слой: Python-код может обойти его через внутренние модули.
+
+Дочерний процесс перед запуском кода:
+- ограничивает процессорное время, память, размер файлов и число дескрипторов
+- отключается от каналов рабочего процесса (fd 0-2 -> /dev/null)
+- ставит audit hook, запрещающий сеть, запуск процессов, запись файлов, ctypes,
+  просмотр каталогов и чтение файлов вне стандартной библиотеки, а также
+  импорт модулей, запускающих процессы без событий аудита (_posixsubprocess)
+- подменяет stdin на вход теста и перехватывает stdout (не больше output_limit)
+
+Модули стандартной библиотеки импортируются заранее, поэтому fork стоит
+около миллисекунды, а каждое решение выполняется в чистом процессе.
+
+Задание: {"code", "stdin", "call", "timeout", "memory_mb", "output_limit"}
+Ответ:   {"status": ok|error|timeout, "stdout", "value", "error", "line", "time_ms"}
+"""
+import collections  # noqa: F401 - прогреваем частые модули до fork
+import datetime  # noqa: F401
+import functools  # noqa: F401
+import io
+import itertools  # noqa: F401
+import json
+import math  # noqa: F401
+import os
+import random
+import re  # noqa: F401
+import resource
+import select
+import signal
+import string  # noqa: F401
+import sys
+import time
+import traceback
+
+BLOCKED_EVENT_PREFIXES = (
+    'socket.', 'subprocess.', 'os.exec', 'os.spawn', 'os.posix_spawn', 'os.fork',
+    'os.system', 'os.kill', 'os.remove', 'os.rename', 'os.rmdir', 'os.mkdir',
+    'os.chmod', 'os.chown', 'os.link', 'os.symlink', 'os.truncate', 'os.putenv',
+    'os.listdir', 'os.scandir', 'glob.',
+    'shutil.', 'ctypes.', 'pty.', 'webbrowser.', 'urllib.', 'ftplib.',
+    'http.', 'smtplib.', 'telnetlib.', 'imaplib.', 'poplib.', 'nntplib.'
+)
+# Запускают процессы и открывают сокеты без событий аудита; выгружаются из
+# sys.modules перед запуском кода, чтобы повторный import прошёл через hook
+BLOCKED_MODULES = frozenset({'_posixsubprocess', '_winapi', '_ctypes', '_socket', 'subprocess', 'socket', 'ctypes'})
+WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+# Читать можно только файлы интерпретатора - для import стандартной библиотеки
+READABLE_PREFIXES = tuple(sorted({
+    os.path.join(os.path.abspath(prefix), '')
+    for prefix in (sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix)
+}))
+
+
+def audit(event, args):
+    if event.startswith(BLOCKED_EVENT_PREFIXES):
+        raise PermissionError(f"{event} запрещено в песочнице")
+    if event == 'import' and args[0].partition('.')[0] in BLOCKED_MODULES:
+        raise ImportError(f"модуль {args[0]} запрещён в песочнице")
+    if event == 'open':
+        path, mode, flags = args
+        if (mode and any(char in mode for char in 'wax+')) or (flags or 0) & WRITE_FLAGS:
+            raise PermissionError("запись файлов запрещена в песочнице")
+        if isinstance(path, (str, bytes)) and not os.path.abspath(os.fsdecode(path)).startswith(READABLE_PREFIXES):
+            raise PermissionError("чтение файлов запрещено в песочнице")
+
+
+class LimitedOutput(io.StringIO):
+    """stdout с ограничением размера - бесконечный print не съест память"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, text):
+        if self.tell() + len(text) > self.limit:
+            raise RuntimeError(f"слишком большой вывод (больше {self.limit} символов)")
+        return super().write(text)
+
+
+def set_limits(job):
+    cpu = max(1, int(job['timeout']) + 1)
+    memory = job['memory_mb'] * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (16, 16))
+
+
+def run_submission(job):
+    """Выполняется в дочернем процессе; возвращает словарь ответа"""
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)  # os.write(1, ...) не подделает ответ рабочего процесса
+    output = LimitedOutput(job['output_limit'])
+    sys.stdin = io.StringIO(job.get('stdin') or '')
+    sys.stdout = output
+    sys.stderr = io.StringIO()
+    random.seed(0)
+    result = {"status": "ok", "value": None}
+    started = time.perf_counter()
+    try:
+        set_limits(job)
+        for name in BLOCKED_MODULES:
+            sys.modules.pop(name, None)
+        sys.addaudithook(audit)
+        namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+        try:
+            exec(compile(job['code'], '<solution>', 'exec'), namespace)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise
+        if job.get('call'):
+            result["value"] = repr(eval(compile(job['call'], '<test>', 'eval'), namespace))
+    except BaseException as e:
+        frames = [frame for frame in traceback.extract_tb(e.__traceback__) if frame.filename == '<solution>']
+        result.update(
+            status="error",
+            error=traceback.format_exception_only(type(e), e)[-1].strip(),
+            line=frames[-1].lineno if frames else getattr(e, 'lineno', None)
+        )
+    result["time_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    result["stdout"] = output.getvalue()
+    return result
+
+
+def run_job(job):
+    """fork + ожидание результата с ограничением по реальному времени"""
+    read_fd, write_fd = os.pipe()
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            payload = json.dumps(run_submission(job), ensure_ascii=False).encode('utf-8')
+        except BaseException as e:
+            payload = json.dumps({"status": "error", "error": f"{type(e).__name__}: {e}"}).encode('utf-8')
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(write_fd, view):]
+        os._exit(0)
+
+    os.close(write_fd)
+    chunks = []
+    deadline = started + job['timeout']
+    timed_out = False
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        ready, _, _ = select.select([read_fd], [], [], remaining)
+        if not ready:
+            continue
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    if timed_out:
+        os.kill(pid, signal.SIGKILL)
+    os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+    elapsed = round((time.monotonic() - started) * 1000, 1)
+
+    if timed_out or os.WIFSIGNALED(status) and os.WTERMSIG(status) in (signal.SIGXCPU, signal.SIGKILL):
+        return {"status": "timeout", "error": f"превышено время выполнения ({job['timeout']} с)", "time_ms": elapsed}
+    if not chunks:
+        return {"status": "error", "error": "процесс завершился без результата (возможно, не хватило памяти)", "time_ms": elapsed}
+    return json.loads(b''.join(chunks))
+
+
+def drop_privileges():
+    """Под root - переход на непривилегированного пользователя SANDBOX_UID
+
+    Модули уже загружены, поэтому исполняемый код не прочитает ни файлы
+    сервера, ни .env, даже если обойдёт audit hook (при закрытых правах).
+    """
+    uid = int(os.environ.get('SANDBOX_UID', -1))
+    if uid < 0 or os.getuid() != 0:
+        return
+    os.setgroups([])
+    os.setgid(uid)
+    os.setuid(uid)
+
+
+def main():
+    drop_privileges()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        reply = run_job(json.loads(line))
+        sys.stdout.write(json.dumps(reply, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()